@@ -1,14 +1,89 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import io
-from PIL import Image
-from google import genai
-from google.genai import types
-from pydantic import BaseModel
-from typing import List
-import json
+from pydantic import BaseModel, Field, ValidationError
+from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_random_exponential
+from typing import List, Optional
+import orjson
 import os
+import textwrap
+import threading
+import time
 from dotenv import load_dotenv
 load_dotenv()
+
+# Heavy third-party modules (google-genai drags in gRPC/protobuf, PIL and
+# the cache libraries have native extensions) are imported lazily inside
+# the functions that need them, keeping session spin-up fast for users
+# who are just reading the page
+
+# Analysis prompt, built once at import instead of per call.
+# Bump PROMPT_VERSION whenever it (or the response schema) changes so
+# stale cached answers are invalidated
+PROMPT_VERSION = "v2"
+PROMPT = textwrap.dedent("""
+    Analyze this food image and provide detailed nutritional information.
+    Identify each food item visible in the image and estimate:
+    1. The name of each food item
+    2. The portion size in grams
+    3. Protein content in grams
+    4. Calories
+    5. Carbohydrates in grams
+
+    Be as accurate as possible with portion estimation based on visual cues like plate size,
+    utensils, or common serving sizes. Provide a confidence level (high/medium/low) for your analysis.
+
+    If multiple food items are present, list each separately.
+    Calculate the total calories for the entire meal.
+    """).strip()
+
+# Variant used when several photos are sent in one request
+BATCH_PROMPT = PROMPT + textwrap.dedent("""
+
+    Several food images are attached. Analyze each image independently and
+    return one analysis per image, in the same order the images appear.
+    """).rstrip()
+
+# Images per Gemini request; larger sets are split into parallel sub-batches
+BATCH_SIZE = 4
+
+# Flash is several times faster and cheaper and handles food identification
+# well; pro is opt-in via the high-accuracy toggle
+DEFAULT_MODEL = "gemini-2.5-flash"
+HIGH_ACCURACY_MODEL = "gemini-2.5-pro"
+
+# Transient API failures (rate limits, server errors, timeouts) are retried
+# with jittered exponential backoff instead of losing the attempt
+RETRY_ATTEMPTS = 4
+
+def is_transient_api_error(exc: BaseException) -> bool:
+    from google.genai import errors
+    if isinstance(exc, errors.APIError):
+        return exc.code == 429 or exc.code >= 500
+    return isinstance(exc, TimeoutError)
+
+def api_retryer(before_sleep=None) -> Retrying:
+    return Retrying(
+        retry=retry_if_exception(is_transient_api_error),
+        wait=wait_random_exponential(multiplier=1, max=30),
+        stop=stop_after_attempt(RETRY_ATTEMPTS),
+        before_sleep=before_sleep,
+        reraise=True,
+    )
+
+# Cached Gemini responses are kept on disk for 30 days
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# Near-duplicate photos (re-shots of the same plate) reuse a prior analysis
+# when their 64-bit perceptual hashes differ by at most this many bits
+PHASH_MAX_DISTANCE = 6
+
+# JPEG uploads at or below this size are sent to Gemini as-is, skipping the
+# decode + resize + re-encode round-trip; larger ones go through the resize path
+JPEG_MAGIC = b'\xff\xd8\xff'
+JPEG_PASSTHROUGH_MAX_BYTES = 1_500_000
 # Configure Streamlit page for mobile optimization
 st.set_page_config(
     page_title="🍎 Food Calorie Scanner",
@@ -17,8 +92,11 @@ st.set_page_config(
     initial_sidebar_state="collapsed"
 )
 
-# Custom CSS for mobile-friendly design
-st.markdown("""
+# Custom CSS for mobile-friendly design, built once per process rather than
+# re-created on every rerun
+@st.cache_resource
+def get_page_css():
+    return """
 <style>
 .main {
     padding-top: 2rem;
@@ -58,111 +136,395 @@ st.markdown("""
     margin: 1rem 0;
 }
 </style>
-""", unsafe_allow_html=True)
+"""
 
-# Pydantic models for structured output
+st.markdown(get_page_css(), unsafe_allow_html=True)
+
+# Pydantic models for structured output. This schema drives Gemini's
+# response, so every field named here is output tokens billed per call:
+# keep it to exactly what the UI displays, and describe each field so the
+# model doesn't spend tokens inferring intent. Portions are integers --
+# the UI formats them with :.0f anyway, and whole grams are fewer digits
+# of JSON to generate.
 class FoodItem(BaseModel):
-    name: str
-    portion_grams: float
-    protein_grams: float
-    calories: float
-    carbs_grams: float
+    name: str = Field(..., description="Name of the food item")
+    portion_grams: int = Field(..., description="Estimated portion size in whole grams")
+    protein_grams: float = Field(..., description="Protein content in grams")
+    calories: float = Field(..., description="Calories in kcal")
+    carbs_grams: float = Field(..., description="Carbohydrate content in grams")
 
 class NutritionAnalysis(BaseModel):
-    food_items: List[FoodItem]
-    total_calories: float
-    confidence_level: str
+    food_items: List[FoodItem] = Field(..., description="One entry per distinct food item visible in the image")
+    total_calories: float = Field(..., description="Total calories for the entire meal in kcal")
+    confidence_level: str = Field(..., description="Overall confidence in the analysis: high, medium or low")
 
-# Initialize Gemini client
+# Initialize Gemini client. The cached client holds one persistent HTTP
+# connection pool, so analyze calls after the first reuse the TCP/TLS
+# session instead of paying a fresh handshake
 @st.cache_resource
 def get_gemini_client():
-    return genai.Client(api_key=os.getenv("GEMINI_API_KEY", ""))
+    from google import genai
+    from google.genai import types
 
-def analyze_food_image(image_bytes: bytes) -> NutritionAnalysis:
-    """Analyze food image using Gemini and return structured nutrition data"""
+    client = genai.Client(
+        api_key=os.getenv("GEMINI_API_KEY", ""),
+        http_options=types.HttpOptions(timeout=30_000),
+    )
+    # Warm the connection with a cheap call so the first analyze click
+    # starts on an already-open TLS session
     try:
-        client = get_gemini_client()
-        
-        prompt = """
-        Analyze this food image and provide detailed nutritional information. 
-        Identify each food item visible in the image and estimate:
-        1. The name of each food item
-        2. The portion size in grams
-        3. Protein content in grams
-        4. Calories
-        5. Carbohydrates in grams
-        
-        Be as accurate as possible with portion estimation based on visual cues like plate size, 
-        utensils, or common serving sizes. Provide a confidence level (high/medium/low) for your analysis.
-        
-        If multiple food items are present, list each separately.
-        Calculate the total calories for the entire meal.
-        """
-        
-        response = client.models.generate_content(
-            model='gemini-2.5-pro',
+        client.models.list()
+    except Exception:
+        pass
+    return client
+
+# Build the client on a background thread while the user is still lining up
+# their photo, so the first analyze click finds it (and its warm connection)
+# ready instead of paying import + gRPC bring-up inside the click
+if not st.session_state.get("_client_warmed"):
+    st.session_state["_client_warmed"] = True
+    _warm_thread = threading.Thread(target=get_gemini_client, daemon=True)
+    add_script_run_ctx(_warm_thread)
+    _warm_thread.start()
+
+# Shared worker pool so analyses run off the script thread and concurrent
+# sessions overlap their network waits instead of queueing behind each other
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=8)
+
+# On-disk response cache shared across sessions and restarts
+@st.cache_resource
+def get_response_cache():
+    import diskcache
+    return diskcache.Cache("./.gemini_cache")
+
+def response_cache_key(image_hash: str, model: str) -> tuple:
+    return (image_hash, model, PROMPT_VERSION)
+
+# On-disk index of perceptual hash -> analysis for near-duplicate matching.
+# The path is namespaced by PROMPT_VERSION so a prompt/schema bump starts a
+# fresh index, matching how response_cache_key invalidates exact-hash entries.
+# Values are (analysis JSON, stored-at timestamp) pairs; diskcache.Index has
+# no native TTL, so expiry is enforced on read.
+@st.cache_resource
+def get_phash_index():
+    import diskcache
+    return diskcache.Index(f"./.gemini_cache/phash-{PROMPT_VERSION}")
+
+def compute_phash(jpeg_bytes: bytes) -> str:
+    """Perceptual hash of the encoded payload we send to Gemini.
+
+    Uses JPEG draft-mode decoding so hashing never pays a full-resolution
+    decode -- pHash downsamples to 32x32 greyscale anyway."""
+    import imagehash
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(jpeg_bytes))
+    img.draft('L', (64, 64))
+    return str(imagehash.phash(img))
+
+def find_similar_analysis(phash: str, model: str) -> Optional[str]:
+    """Return a cached analysis JSON string from the same model whose
+    perceptual hash is within PHASH_MAX_DISTANCE bits of the given hash,
+    or None. Callers rehydrate via NutritionAnalysis.model_validate_json.
+
+    Entries that have expired or no longer validate against the current
+    schema are dropped rather than returned."""
+    index = get_phash_index()
+    target = int(phash, 16)
+    for key in list(index.keys()):
+        stored_model, stored_hash = key
+        if stored_model != model:
+            continue
+        if bin(target ^ int(stored_hash, 16)).count('1') > PHASH_MAX_DISTANCE:
+            continue
+        result, stored_at = index[key]
+        if time.time() - stored_at > CACHE_TTL_SECONDS:
+            index.pop(key, None)
+            continue
+        try:
+            NutritionAnalysis.model_validate_json(result)
+        except ValidationError:
+            index.pop(key, None)
+            continue
+        return result
+    return None
+
+def _parse_partial_analysis(buffer: str) -> NutritionAnalysis:
+    """Best-effort parse of a partially streamed structured response.
+
+    Truncates the buffer at the last completed food item and closes the
+    JSON, so early items can render while the rest is still generating.
+    Returns None until at least one item is complete."""
+    end = buffer.rfind('}')
+    if end == -1:
+        return None
+    candidate = buffer[:end + 1]
+    try:
+        data = orjson.loads(candidate)
+    except ValueError:
+        try:
+            data = orjson.loads(candidate + ']}')
+        except ValueError:
+            return None
+    items = data.get('food_items')
+    if not items:
+        return None
+    data.setdefault('total_calories', sum(item.get('calories', 0) for item in items))
+    data.setdefault('confidence_level', '...')
+    try:
+        return NutritionAnalysis.model_validate(data)
+    except Exception:
+        return None
+
+def analyze_food_image(image_bytes: bytes, model: str = DEFAULT_MODEL, on_partial=None, on_retry=None) -> NutritionAnalysis:
+    """Analyze food image using Gemini and return structured nutrition data.
+
+    Streams the response so on_partial (if given) is called with a partial
+    NutritionAnalysis as soon as each food item is complete -- first paint
+    happens at time-to-first-item instead of full generation time.
+    Transient API failures are retried with backoff; on_retry (if given)
+    is told the upcoming attempt number so the UI can show it. Raises on
+    persistent failure; the caller reports the error to the user."""
+    from google.genai import types
+
+    client = get_gemini_client()
+
+    def attempt() -> NutritionAnalysis:
+        buffer = ""
+        items_shown = 0
+        for chunk in client.models.generate_content_stream(
+            model=model,
             contents=[
                 types.Part.from_bytes(
                     data=image_bytes,
                     mime_type='image/jpeg',
                 ),
-                prompt
+                PROMPT
             ],
             config={
                 "response_mime_type": "application/json",
                 "response_schema": NutritionAnalysis,
             }
+        ):
+            if not chunk.text:
+                continue
+            buffer += chunk.text
+            if on_partial is not None:
+                partial = _parse_partial_analysis(buffer)
+                if partial is not None and len(partial.food_items) > items_shown:
+                    items_shown = len(partial.food_items)
+                    on_partial(partial)
+
+        return NutritionAnalysis.model_validate_json(buffer)
+
+    def notify_retry(retry_state):
+        if on_retry is not None:
+            on_retry(retry_state.attempt_number + 1)
+
+    return api_retryer(before_sleep=notify_retry)(attempt)
+
+@st.cache_data(show_spinner=False)
+def analyze_food_image_cached(image_hash: str, phash: str, image_bytes: bytes, model: str = DEFAULT_MODEL, _on_partial=None, _on_retry=None) -> str:
+    """Cache analyze_food_image results keyed by image content hash.
+
+    Identical image bytes skip the Gemini call entirely: hits are served
+    from Streamlit's in-memory cache within a session and from the on-disk
+    cache across sessions. Near-duplicate photos (slightly different
+    framing or compression of the same plate) are matched by perceptual
+    hash. Failed analyses raise, so they are never cached.
+    """
+    cache = get_response_cache()
+    cache_key = response_cache_key(image_hash, model)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    similar = find_similar_analysis(phash, model)
+    if similar is not None:
+        return similar
+
+    analysis = analyze_food_image(image_bytes, model, on_partial=_on_partial, on_retry=_on_retry)
+    # Cached as the Pydantic JSON string: rehydration goes through
+    # model_validate_json straight into pydantic-core, skipping the
+    # Python dict round-trip
+    result = analysis.model_dump_json()
+    cache.set(cache_key, result, expire=CACHE_TTL_SECONDS)
+    # Only confident answers are reused for near-duplicate photos
+    if analysis.confidence_level != 'low':
+        get_phash_index()[(model, phash)] = (result, time.time())
+    return result
+
+def analyze_food_images(images: List[bytes], model: str = DEFAULT_MODEL) -> List[NutritionAnalysis]:
+    """Analyze several food images in a single Gemini request.
+
+    All images ride in one generate_content call, amortizing the network
+    round-trip and model-invocation overhead across the batch. Returns
+    one NutritionAnalysis per image, in order. Transient API failures are
+    retried with backoff."""
+    from google.genai import types
+
+    client = get_gemini_client()
+
+    def attempt():
+        return client.models.generate_content(
+            model=model,
+            contents=[
+                types.Part.from_bytes(data=image_bytes, mime_type='image/jpeg')
+                for image_bytes in images
+            ] + [BATCH_PROMPT],
+            config={
+                "response_mime_type": "application/json",
+                "response_schema": list[NutritionAnalysis],
+            }
         )
-        
-        return response.parsed
-    
-    except Exception as e:
-        st.error(f"Error analyzing image: {str(e)}")
-        return None
 
-def display_nutrition_results(analysis: NutritionAnalysis):
-    """Display nutrition analysis results in a mobile-friendly format"""
-    
-    # Total calories display
-    st.markdown(f"""
+    parsed = api_retryer()(attempt).parsed
+    # A short response must fail loudly here: zipping a truncated list
+    # against the batch would silently leave images unanalyzed and poison
+    # the caches with missing entries
+    if parsed is None or len(parsed) != len(images):
+        returned = 0 if parsed is None else len(parsed)
+        raise ValueError(f"Gemini returned {returned} analyses for {len(images)} images")
+    return parsed
+
+@st.cache_data(show_spinner=False)
+def analyze_food_images_cached(image_hashes: tuple, images: tuple, model: str = DEFAULT_MODEL) -> list:
+    """Batch analysis with per-image reuse of the response cache.
+
+    Images already analyzed before (by exact content hash) are served from
+    the disk cache; only the misses go to Gemini, in sub-batches of
+    BATCH_SIZE run in parallel on a per-call pool. This function already
+    executes on the shared executor, so sub-batches must not be submitted
+    back to it: blocking on them from inside a shared-pool task would
+    deadlock once all workers hold outer tasks."""
+    cache = get_response_cache()
+    results = [cache.get(response_cache_key(h, model)) for h in image_hashes]
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        batches = [missing[i:i + BATCH_SIZE] for i in range(0, len(missing), BATCH_SIZE)]
+        if len(batches) == 1:
+            batch_results = [analyze_food_images([images[i] for i in batches[0]], model)]
+        else:
+            with ThreadPoolExecutor(max_workers=len(batches)) as pool:
+                batch_results = list(pool.map(
+                    lambda batch: analyze_food_images([images[i] for i in batch], model),
+                    batches,
+                ))
+        for batch, analyses in zip(batches, batch_results):
+            for i, analysis in zip(batch, analyses):
+                result = analysis.model_dump_json()
+                results[i] = result
+                cache.set(response_cache_key(image_hashes[i], model), result, expire=CACHE_TTL_SECONDS)
+    return results
+
+# HTML templates for the results view, parsed once at import and expanded
+# with str.format per render
+TOTAL_TEMPLATE = """
     <div class="total-calories">
-        🔥 Total Calories: {analysis.total_calories:.0f} kcal
-        <br><small>Confidence: {analysis.confidence_level}</small>
+        🔥 Total Calories: {total_calories:.0f} kcal
+        <br><small>Confidence: {confidence_level}</small>
     </div>
-    """, unsafe_allow_html=True)
-    
-    # Individual food items
-    st.subheader("📋 Food Items Detected")
-    
-    for i, item in enumerate(analysis.food_items, 1):
-        st.markdown(f"""
+    <h3>📋 Food Items Detected</h3>
+    """
+
+ITEM_TEMPLATE = """
         <div class="food-item">
-            <h4>🍽️ {item.name}</h4>
-            <p><strong>Portion:</strong> {item.portion_grams:.0f}g</p>
+            <h4>🍽️ {name}</h4>
+            <p><strong>Portion:</strong> {portion_grams:.0f}g</p>
             <div class="nutrition-grid">
                 <div class="nutrition-item">
                     <div style="font-size: 1.2rem; color: #ff6b6b;">🔥</div>
-                    <div style="font-weight: bold;">{item.calories:.0f}</div>
+                    <div style="font-weight: bold;">{calories:.0f}</div>
                     <div style="font-size: 0.8rem;">Calories</div>
                 </div>
                 <div class="nutrition-item">
                     <div style="font-size: 1.2rem; color: #4ecdc4;">💪</div>
-                    <div style="font-weight: bold;">{item.protein_grams:.1f}g</div>
+                    <div style="font-weight: bold;">{protein_grams:.1f}g</div>
                     <div style="font-size: 0.8rem;">Protein</div>
                 </div>
                 <div class="nutrition-item">
                     <div style="font-size: 1.2rem; color: #45b7d1;">🌾</div>
-                    <div style="font-weight: bold;">{item.carbs_grams:.1f}g</div>
+                    <div style="font-weight: bold;">{carbs_grams:.1f}g</div>
                     <div style="font-size: 0.8rem;">Carbs</div>
                 </div>
             </div>
         </div>
-        """, unsafe_allow_html=True)
+        """
+
+@st.cache_data(show_spinner=False)
+def render_nutrition_html(analysis_json: str) -> str:
+    """Build the results HTML for a serialized NutritionAnalysis.
+
+    Keyed by Pydantic's deterministic JSON, so reruns that re-display the
+    same analysis (unrelated widget clicks, the "Last Analysis" path) are
+    a cache lookup instead of re-running all the string formatting."""
+    analysis = NutritionAnalysis.model_validate_json(analysis_json)
+
+    # One template expansion per item, emitted later as a single markdown
+    # call -- one websocket frame to the browser regardless of item count
+    return TOTAL_TEMPLATE.format(
+        total_calories=analysis.total_calories,
+        confidence_level=analysis.confidence_level,
+    ) + "".join(
+        ITEM_TEMPLATE.format(**item.model_dump()) for item in analysis.food_items
+    )
+
+def display_nutrition_results(analysis: NutritionAnalysis):
+    """Display nutrition analysis results in a mobile-friendly format"""
+    st.markdown(render_nutrition_html(analysis.model_dump_json()), unsafe_allow_html=True)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def prepare_image_bytes(raw: bytes) -> bytes:
+    """Turn one uploaded/captured image into the JPEG payload for Gemini.
+
+    Cached on the raw upload bytes, since the preview and the analyze
+    paths both want the payload and reruns should not re-pay the resize."""
+    if raw[:3] == JPEG_MAGIC and len(raw) <= JPEG_PASSTHROUGH_MAX_BYTES:
+        # Camera captures and JPEG uploads within budget go to
+        # Gemini as-is: no decode, no re-encode
+        return raw
+
+    # Downscale and re-encode before upload: food identification
+    # is insensitive to resolution beyond ~1024px, so this cuts
+    # upload time and vision-token cost without hurting accuracy.
+    # When pyvips is installed it handles this step -- libvips streams the
+    # resize tile-wise with SIMD and is several times faster than Pillow's
+    # scalar LANCZOS + encode on full-size phone shots
+    try:
+        import pyvips
+    except ImportError:
+        pass
+    else:
+        vimg = pyvips.Image.thumbnail_buffer(raw, 1024, height=1024)
+        if vimg.hasalpha():
+            vimg = vimg.flatten(background=[255, 255, 255])
+        return vimg.jpegsave_buffer(Q=85, optimize_coding=True, interlace=True, strip=True)
+
+    from PIL import Image
+
+    image = Image.open(io.BytesIO(raw)).convert('RGB')
+    image.thumbnail((1024, 1024), Image.Resampling.LANCZOS)
+    # Reuse one encode buffer per session instead of
+    # allocating a fresh BytesIO on every click
+    buf = st.session_state.setdefault("_jpeg_buf", io.BytesIO())
+    buf.seek(0)
+    buf.truncate()
+    image.save(buf, format='JPEG', quality=85, optimize=True, progressive=True)
+    return bytes(buf.getbuffer())
 
 # Main app
 def main():
     st.title("🍎 Food Calorie Scanner")
     st.markdown("📱 *Take a photo of your food to get instant nutrition analysis*")
+
+    # Model selection: flash by default, pro behind an explicit toggle
+    high_accuracy = st.sidebar.toggle(
+        "🎯 High-accuracy mode",
+        help="Use the slower, pricier pro model for tricky photos"
+    )
+    model = HIGH_ACCURACY_MODEL if high_accuracy else DEFAULT_MODEL
     
     # API Key input (for development)
     # if "GEMINI_API_KEY" not in st.secrets:
@@ -190,53 +552,118 @@ def main():
     # Camera widget
     camera_image = st.camera_input("📷 Take a picture of your food")
     
-    # Alternative: File upload for testing
-    st.markdown("*Or upload an image:*")
-    uploaded_file = st.file_uploader(
-        "Choose an image...", 
+    # Alternative: File upload for testing; several photos are analyzed
+    # together in a single batched request
+    st.markdown("*Or upload one or more images:*")
+    uploaded_files = st.file_uploader(
+        "Choose an image...",
         type=['jpg', 'jpeg', 'png'],
+        accept_multiple_files=True,
         label_visibility="collapsed"
     )
-    
-    # Process image
-    image_source = camera_image or uploaded_file
-    
-    if image_source is not None:
-        # Display the image
-        st.subheader("🖼️ Your Food Photo")
-        image = Image.open(image_source)
-        st.image(image, caption="Food to analyze", use_column_width=True)
-        
+
+    # Process images
+    image_sources = [camera_image] if camera_image else (uploaded_files or [])
+
+    if image_sources:
+        # Preview the prepared (size-bounded) payloads at a fixed width
+        # instead of shipping the full-resolution originals to the browser
+        payloads = [prepare_image_bytes(source.getvalue()) for source in image_sources]
+        if len(payloads) == 1:
+            st.subheader("🖼️ Your Food Photo")
+            st.image(payloads[0], caption="Food to analyze", width=400)
+        else:
+            st.subheader("🖼️ Your Food Photos")
+            st.image(payloads, width=400)
+
         # Analyze button
         if st.button("🔍 Analyze Nutrition", type="primary", use_container_width=True):
-            
+
             # Check for API key
             # if "GEMINI_API_KEY" not in st.secrets and "gemini_api_key" not in st.session_state:
             #     st.error("⚠️ Please enter your Gemini API key to proceed")
             #     return
-            
-            with st.spinner("🤖 AI is analyzing your food..."):
-                # Convert image to bytes
-                img_bytes = io.BytesIO()
-                image.save(img_bytes, format='JPEG')
-                img_bytes = img_bytes.getvalue()
-                
-                # Analyze with Gemini
-                analysis = analyze_food_image(img_bytes)
-                
-                if analysis:
+
+            # Submit the analysis to the worker pool so the script (and
+            # other sessions in this process) never block on the API call.
+            # Streamed partial results land in the shared progress dict,
+            # which the polling block below renders on each rerun.
+            progress = {}
+            ctx = get_script_run_ctx()
+
+            if len(payloads) == 1:
+                img_bytes = payloads[0]
+                image_hash = hashlib.sha256(img_bytes).hexdigest()
+                phash = compute_phash(img_bytes)
+
+                def run_analysis():
+                    add_script_run_ctx(ctx=ctx)
+                    return analyze_food_image_cached(
+                        image_hash, phash, img_bytes, model,
+                        _on_partial=lambda partial: progress.__setitem__("partial", partial),
+                        _on_retry=lambda attempt: progress.__setitem__("retry", attempt),
+                    )
+            else:
+                image_hashes = tuple(hashlib.sha256(b).hexdigest() for b in payloads)
+
+                def run_analysis():
+                    add_script_run_ctx(ctx=ctx)
+                    return analyze_food_images_cached(image_hashes, tuple(payloads), model)
+
+            st.session_state["pending_analysis"] = {
+                "future": get_executor().submit(run_analysis),
+                "progress": progress,
+                "batch": len(payloads) > 1,
+            }
+            st.rerun()
+
+    # Poll a pending background analysis: show streamed partial results
+    # while it runs, then the final result when the future completes
+    pending = st.session_state.pop("pending_analysis", None)
+    if pending is not None:
+        future = pending["future"]
+        if not future.done():
+            st.session_state["pending_analysis"] = pending
+            retry_attempt = pending["progress"].get("retry")
+            spinner_text = "🤖 AI is analyzing your food..."
+            if retry_attempt:
+                spinner_text = f"🤖 AI is analyzing your food... (retrying, attempt {retry_attempt})"
+            with st.spinner(spinner_text):
+                partial = pending["progress"].get("partial")
+                if partial is not None:
+                    display_nutrition_results(partial)
+                time.sleep(0.3)
+            st.rerun()
+        else:
+            # Validation and rendering stay inside the try so a bad cached
+            # payload degrades to the error message, not a traceback page
+            try:
+                result = future.result()
+                if pending["batch"]:
                     st.success("✅ Analysis complete!")
-                    display_nutrition_results(analysis)
-                    
-                    # Save to session state for later reference
-                    st.session_state["last_analysis"] = analysis
+                    for i, item_result in enumerate(result, 1):
+                        st.markdown(f"**📷 Photo {i}**")
+                        st.markdown(render_nutrition_html(item_result), unsafe_allow_html=True)
                 else:
-                    st.error("❌ Failed to analyze the image. Please try again.")
-    
-    # Show previous analysis if available
-    if "last_analysis" in st.session_state and image_source is None:
+                    analysis = NutritionAnalysis.model_validate_json(result)
+                    html = render_nutrition_html(result)
+                    st.success("✅ Analysis complete!")
+                    st.markdown(html, unsafe_allow_html=True)
+
+                    # Save both the parsed object and the rendered HTML so
+                    # later reruns re-display the result without any
+                    # serialization or formatting work
+                    st.session_state["last_analysis"] = analysis
+                    st.session_state["last_html"] = html
+            except Exception as e:
+                st.error(f"Error analyzing image: {str(e)}")
+                st.error("❌ Failed to analyze the image. Please try again.")
+
+    # Show previous analysis if available: the stored HTML string goes
+    # straight to the browser
+    if "last_html" in st.session_state and not image_sources:
         st.subheader("📊 Last Analysis")
-        display_nutrition_results(st.session_state["last_analysis"])
+        st.markdown(st.session_state["last_html"], unsafe_allow_html=True)
     
     # Footer
     st.markdown("---")